@@ -2,17 +2,55 @@
 """Fetch emails from IMAP server and save them as .eml"""
 import argparse
 import configparser
-import email
+import errno
 import imaplib
+import json
+import mmap
+import os
 import re
+import select
 import ssl
 import sys
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import nullcontext, suppress
+from email.parser import BytesFeedParser
+from email.policy import compat32
 from getpass import getpass
+from itertools import groupby, islice
 from os import listdir, remove
 from pathlib import Path
-from time import sleep, localtime as _now, strftime
-from zipfile import ZIP_LZMA, ZipFile as zf
+from queue import Empty, Queue
+from threading import BoundedSemaphore, Event, Lock, Thread
+from time import localtime as _now, monotonic, strftime
+from zipfile import ZIP_DEFLATED, ZIP_LZMA, ZIP_STORED, ZipFile as zf
+import zipfile
+
+COMPRESSION = {"stored": ZIP_STORED, "deflate": ZIP_DEFLATED, "lzma": ZIP_LZMA}
+if hasattr(zipfile, "ZIP_ZSTANDARD"): # python >= 3.14
+    COMPRESSION["zstd"] = zipfile.ZIP_ZSTANDARD
+COMPRESS_LEVEL = {"deflate": 1, "zstd": 3} # cheap levels, mails are mostly text and compress well anyway
+
+_FETCH_PARTS = b"(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)] BODY.PEEK[])" # PEEK leaves \Seen alone
+_FETCH_WINDOW = 32 # FETCH commands sent ahead of their replies
+_IDX_RE = re.compile(r"(\d+)_")
+_UID_RE = re.compile(rb"UID (\d+)")
+_SECTION_RE = re.compile(rb"BODY\[(.*)\] \{\d+\}$")
+_CHARSET_RE = re.compile(r"utf-[0-9][a-z]|iso-[0-9]+-[0-9][a-z]", re.IGNORECASE)
+_BAD_CHARS_RE = re.compile(r"[^\w@.\- ]+") # \w keeps non-ascii letters and digits, like str.isalnum()
+_DIRECT_ALIGN = 4096
+_HEADER_LIMIT = 64 * 1024 # upper bound for a header block, if the end can't be found
+INDEX_FILE = ".fetched"
+INDEX_MARKER = "uidvalidity" # first line of the index, uids are only valid for the UIDVALIDITY they came with
+FAILED_FILE = ".failed" # uids that couldn't be fetched or saved, asked for again on the next run
+IDLE_TIMEOUT = 29 * 60 # servers may drop idle clients after 30 minutes (RFC 2177)
+RECONNECT_DELAY = 60
+_interrupted = Event()
+_write_slots = BoundedSemaphore(32) # mails fetched but not written yet, across all connections
+
+def now() -> str:
+    return strftime("%H:%M:%S", _now())
 
 def dir_path(path) -> str:
     if Path(path).exists():
@@ -21,119 +59,440 @@ def dir_path(path) -> str:
         raise argparse.ArgumentTypeError(f"dir: {path} is not a valid path")
 
 def check_response(func, action="") -> 'tuple(str,bytes)':
-    try:
-        typ, data = func
-        assert 'OK' in typ
-    except:
+    typ, data = func
+    if 'OK' not in typ:
         raise RuntimeError(f"{action}: {typ} / {data}")
 
     return typ, data
 
 def sanitize_string(string) -> 'str | None':
-    try: # does not work for every special char, but better than nothing
-        string = re.sub(r"utf-[0-9][a-z]|iso-[0-9]+-[0-9][a-z]", "", string, flags=re.IGNORECASE).strip()
-        return "".join([c for c in string if c in ("@", "-", "_", ".", " ") or c.isalnum()])[:35]
-    except:
+    if not string:
         return None
 
-def main(args) -> None:
-    now = lambda: strftime("%H:%M:%S", _now())
-    included = list(filter(len, args.include.split(",")))
-    excluded = list(filter(len, args.exclude.split(",")))
-    archive_path = f"{args.dir}/mails.zip"
-    if Path(archive_path).exists() and args.zip and args.all:
-        remove(archive_path)
-
-    bytify = lambda x: bytes(str(x), 'ascii') if type(x) != bytes else x
+    # does not work for every special char, but better than nothing
+    string = _CHARSET_RE.sub("", string).strip()
+    return _BAD_CHARS_RE.sub("", string)[:35]
+
+def compress_set(nums) -> str:
+    """IMAP sequence set with consecutive numbers as ranges: [1, 2, 3, 5, 7, 8] -> '1:3,5,7:8'"""
+    runs = (list(run) for _, run in groupby(enumerate(sorted(nums)), key=lambda t: t[1] - t[0]))
+    return ",".join(f"{run[0][1]}:{run[-1][1]}" if len(run) > 1 else str(run[0][1]) for run in runs)
+
+def check_uidvalidity(stored, uidvalidity, where) -> None:
+    if stored is None: # archived by a version that named files by sequence number, those would be taken for uids
+        raise RuntimeError(f"{where} has mails but no UIDVALIDITY recorded, they may be named by sequence number"
+                           " (older version), run with --all to fetch them again")
+    if stored != uidvalidity:
+        raise RuntimeError(f"UIDVALIDITY of {where} changed from {stored} to {uidvalidity}, the archived uids"
+                           " don't match the server's anymore, run with --all to fetch them again")
+
+def read_index(index_path) -> 'tuple(int|None,set[int])':
+    """(uidvalidity, uids) from an index file, uidvalidity is None if the marker line is missing"""
+    lines = index_path.read_text().split("\n", 1)
+    marker = lines[0].split()
+    if len(marker) != 2 or marker[0] != INDEX_MARKER:
+        return None, set(map(int, "\n".join(lines).split()))
+    return int(marker[1]), set(map(int, lines[1].split())) if len(lines) > 1 else set()
+
+def parse_fetch_response(responses) -> 'Iterator[tuple(int,bytes,bytes)]':
+    """Yield (uid, headers, mail) per message from untagged FETCH data, keyed by the UID the server sent
+    rather than by position, other FETCH responses (e.g. unsolicited flag updates) are skipped"""
+    # [(b'1 (UID 5 BODY[HEADER.FIELDS (FROM SUBJECT)] {57}', b'From: ...'), (b' BODY[] {3642}', b'...'), b')']
+    uid, parts = None, {}
+    for item in responses:
+        # literals come as (prefix, data) tuples, everything else as plain bytes, UID may be in either
+        prefix = item[0] if type(item) == tuple else item
+        if (m := _UID_RE.search(prefix)):
+            uid = int(m.group(1))
+        if type(item) == tuple and (m := _SECTION_RE.search(prefix)):
+            parts[m.group(1)] = item[1]
+        if prefix.endswith(b')'): # end of this message's response
+            if uid is not None and b'' in parts:
+                yield uid, next((v for k, v in parts.items() if k), b''), parts[b'']
+            uid, parts = None, {}
+
+def parse_headers(headers, mail) -> 'email.message.Message':
+    """Parse only a header block, so memory use doesn't depend on the size of the mail"""
+    if not headers: # server left out the HEADER.FIELDS item, fall back to the mail's own header block
+        end = mail.find(b"\r\n\r\n", 0, _HEADER_LIMIT)
+        headers = mail[:end + 4] if end >= 0 else mail[:_HEADER_LIMIT]
+
+    parser = BytesFeedParser(policy=compat32)
+    parser.feed(headers)
+    return parser.close()
+
+def header_value(message, name) -> 'str | None':
+    # raw value, compat32 would turn undeclared 8-bit (mostly utf-8) into a Header of replacement chars
+    name = name.lower()
+    for key, value in message.raw_items():
+        if key.lower() == name:
+            return value.encode('ascii', errors='surrogateescape').decode('utf-8', errors='replace')
+    return None
 
-    with Connection(args.username, args.password, args.server, args.port) as imap:
-        if len(included) > 0 and not args.list_mailboxes:
-            mailboxes = included
+def process_mailbox(imap, mailbox, args, archive=None, pool=None, keep_selected=False) -> None:
+    _, count = check_response(imap.select(mailbox, readonly=True), "select") 
+    # ('OK', [b'7'])
+    imap.response('EXISTS') # clears it, with --daemon only mail arriving from here on counts as new
+    _, validity = imap.response('UIDVALIDITY')
+    # ('UIDVALIDITY', [b'1404219503'])
+    uidvalidity = int(validity[0] or 0)
+    print(f"{now()} -- {int(count[0])} total in {mailbox}")
+
+    path = Path(f"{args.dir}/{mailbox}").absolute().as_posix()
+    index_path = Path(f"{path}/{INDEX_FILE}") # uids saved so far, one per line
+    failed_path = Path(f"{path}/{FAILED_FILE}")
+    if not args.zip:
+        Path(path).mkdir(parents=True, exist_ok=True)
+
+    ids, retry = set(), set()
+    if not args.all: # fetch only, if no file for uid exists
+        if args.zip:
+            prefix = f"{mailbox}/"
+            names = [x[len(prefix):] for x in archive.names if x.startswith(prefix)]
+            ids = set(int(m.group(1)) for m in map(_IDX_RE.match, names) if m)
+            if ids:
+                check_uidvalidity(archive.uidvalidity.get(mailbox), uidvalidity, f"{archive.path}/{mailbox}")
+            retry = archive.retry.get(mailbox, set())
+        elif index_path.exists():
+            stored, ids = read_index(index_path)
+            check_uidvalidity(stored, uidvalidity, path)
+            retry = set(map(int, failed_path.read_text().split())) if failed_path.exists() else set()
         else:
-            _, _mailboxes = check_response(imap.list(), "list")
-            # ('OK', [b'(\\HasNoChildren) "/" INBOX', b'(\\HasNoChildren) "/" Sent', ...])
-            mailboxes = [m.decode('utf-8').split()[-1] for m in _mailboxes]
-            sleep(0.2)
+            ids = set()
+            if any(map(_IDX_RE.match, listdir(path))): # mails, but no index to tell what their names mean
+                check_uidvalidity(None, uidvalidity, path)
+
+    if not args.dry_run: # a new index, or one made again from scratch with --all
+        if args.zip:
+            archive.uidvalidity[mailbox] = uidvalidity
+        elif args.all or not index_path.exists():
+            index_path.write_text(f"{INDEX_MARKER} {uidvalidity}\n")
+
+    if ids and retry is not None: # only ask for what is newer than the last run, and what failed in it
+        last_uid = max(ids)
+        uid_set = ",".join(filter(len, [compress_set(retry), f"{last_uid + 1}:*"]))
+        _, uids = check_response(imap.uid('SEARCH', None, f"UID {uid_set}"), "search")
+        # 'n:*' always matches the highest uid, even if that is lower than n
+        fetch = sorted(uid for uid in map(int, uids[0].split()) if uid > last_uid or uid in retry)
+    else: # first run, --all, or the failed uids weren't recorded
+        _, uids = check_response(imap.uid('SEARCH', None, 'ALL'), "search")
+        # ('OK', [b'3 5 6 9'])
+        fetch = [uid for uid in map(int, uids[0].split()) if args.all or uid not in ids]
+
+    print(f"{now()} --- {len(fetch)} to fetch for {mailbox}")
+    batches = (fetch[x:x + args.batch_size] for x in range(0, len(fetch), args.batch_size))
+    # [[3], [5], ...] if --batch wasn't requested, batch_size will be 1
+
+    if args.zip and not args.dry_run:
+        archive.expect(mailbox, fetch)
+
+    with FileWriter(path, pool, fetch, args.o_direct) if not args.zip and not args.dry_run else nullcontext() as writer:
+        for batch in batches:
+            if _interrupted.is_set():
+                break
+
+            try:
+                done = []
+                for msg_id, headers, mail in imap.send_fetch_pipelined(batch):
+                    message = parse_headers(headers, mail)
+                    subject = sanitize_string(header_value(message, 'Subject')) or "no_subject"
+                    from_addr = sanitize_string(header_value(message, 'From')) or "no_sender"
+                    file_name = f"{msg_id}_{from_addr}__{subject}.eml"
+
+                    if not args.dry_run: # saved as sent by the server
+                        if args.zip:
+                            archive.write(mailbox, msg_id, file_name, mail)
+                        else:
+                            writer.write(msg_id, file_name, mail)
+                    else:
+                        print("--dry-run: would: ", file_name)
 
-        print(f"{now()} - got these mailboxes: {','.join(mailboxes)}")
-        if args.list_mailboxes:
-            return None
+                    done.append(msg_id)
 
-        mailboxes = [mb for mb in mailboxes if mb not in excluded]
-        print(f"{now()} - will do: {','.join(mailboxes)}")
+                if writer:
+                    writer.flush()
 
-        for mailbox in mailboxes:
-            _, count = check_response(imap.select(mailbox, readonly=True), "select") 
-            # ('OK', [b'7'])
-            indexes = range(1, int(count[0]) + 1)
-            print(f"{now()} -- {len(indexes)} total in {mailbox}")
+                missing = [str(i) for i in batch if i not in done]
+                if missing:
+                    print(f"{now()} ---- failed to do {','.join(missing)}")
 
-            path = Path(f"{args.dir}/{mailbox}").absolute().as_posix()
-            
+            except imaplib.IMAP4.abort: # connection is gone, no point in trying the next batch
+                raise
 
-            if not args.all: # fetch only, if no file for index exists
-                if args.zip:
-                    with zf(archive_path, "a") as archive:
-                        check_list = [x for x in archive.namelist() if mailbox in x] 
+            except (imaplib.IMAP4.error, OSError):
+                print(f"{now()} ---- failed to do {','.join(map(str, batch))}")
+                # raise
 
-                    check_list = list(map(lambda x: x.split(f"{mailbox}/")[-1], check_list))
-                else:
-                    Path(path).mkdir(parents=True, exist_ok=True)
-                    check_list = listdir(path)
+    if not keep_selected: # --daemon goes on to IDLE in it
+        check_response(imap.close())
+    print(f"{now()} -- done with {mailbox}")
 
-                files = filter(re.compile(r"\d+_").match, check_list)
-                ids = list(map(lambda x: int(x.split("_")[0]), files))
-                fetch = [i for i in indexes if i not in ids]
-            else:
-                fetch = indexes
-
-            print(f"{now()} --- {len(fetch)} to fetch for {mailbox}")
-            chunks = (fetch[x:x + args.batch_size] for x in range(0, len(fetch), args.batch_size))
-            # [range(1,2), range(2,3), ...] if --batch wasn't requested, batch_size will be 1
-            batches = (",".join((str(item) for item in chunk)) for chunk in chunks)
-            # ['1,2,3,4,5', '6,7']
-
-            for batch in batches:
-                try:
-                    _, _mails = check_response(imap.fetch(bytify(batch), '(RFC822)'), "fetch")
-                    # ('OK', [(b'1 (RFC822 {3642}', b'email header + msg \r\n'), b')'])
-                    mails = (m for m in _mails if m not in (b')', b'(', b''))
-                    messages = (email.message_from_bytes(mail[1]) for mail in mails) # easier header parsing
-
-                    for msg_id in batch.split(","):
-                        message = next(messages)
-                        subject = sanitize_string(message['Subject']) or "no_subject"
-                        from_addr = sanitize_string(message['From']) or "no_sender"
-                        file_name = f"{int(msg_id)}_{from_addr}__{subject}.eml"
-
-                        if not args.dry_run:
-                            msg_content = message.as_bytes()
-
-                            if args.zip:
-                                with zf(archive_path, mode="a", compression=ZIP_LZMA) as archive:
-                                    archive.writestr(f"{mailbox}/{file_name}", msg_content)
-                            else:
-                                with open(f"{path}/{file_name}", "wb") as f:
-                                    f.write(msg_content)
-                        else:
-                            print("--dry-run: would: ", file_name)
-
-                    sleep(0.2)
+def main(args) -> None:
+    included = list(filter(len, args.include.split(",")))
+    excluded = list(filter(len, args.exclude.split(",")))
+    archive_path = f"{args.dir}/mails.zip"
+    if Path(archive_path).exists() and args.zip and args.all:
+        remove(archive_path)
 
-                except KeyboardInterrupt:
-                    print(f"{now()} - Interrupted.")
-                    sys.exit(130)
+    if len(included) > 0 and not args.list_mailboxes:
+        mailboxes = included
+    else: # the workers open their own connections, this one is only for LIST
+        with Connection(args.username, args.password, args.server, args.port) as imap:
+            _, _mailboxes = check_response(imap.list(), "list")
+            # ('OK', [b'(\\HasNoChildren) "/" INBOX', b'(\\HasNoChildren) "/" Sent', ...])
+            mailboxes = [m.decode('utf-8').split()[-1] for m in _mailboxes]
 
-                except Exception:
-                    print(f"{now()} ---- failed to do {batch}")
-                    # raise
+    print(f"{now()} - got these mailboxes: {','.join(mailboxes)}")
+    if args.list_mailboxes:
+        return None
 
-            check_response(imap.close())
-            print(f"{now()} -- done with {mailbox}")
+    mailboxes = [mb for mb in mailboxes if mb not in excluded]
+    print(f"{now()} - will do: {','.join(mailboxes)}")
+    if args.daemon and len(mailboxes) > args.connections:
+        sys.exit(f"--daemon needs one connection per mailbox, raise --connections to {len(mailboxes)}"
+                 " or select fewer mailboxes")
+
+    todo = Queue()
+    for mailbox in mailboxes:
+        todo.put(mailbox)
+    failed = []
+
+    def worker():
+        # one connection per worker, mailboxes are handed out until none are left
+        imap = None
+        while not _interrupted.is_set():
+            try:
+                mailbox = todo.get_nowait()
+            except Empty:
+                break
+
+            try:
+                imap = imap or Connection(args.username, args.password, args.server, args.port)
+                process_mailbox(imap, mailbox, args, archive, pool)
+            except Exception as e: # a dead thread would silently drop the mailboxes still in the queue
+                print(f"{now()} - failed to do {mailbox}: {e!r}")
+                failed.append(mailbox)
+                if imap and isinstance(e, (imaplib.IMAP4.abort, OSError)): # connection is gone, the next mailbox gets a new one
+                    with suppress(OSError):
+                        imap.shutdown()
+                    imap = None
+
+        if imap:
+            imap.logout()
+
+    def watcher(mailbox):
+        # --daemon: IDLE needs a selected mailbox, so every mailbox keeps its own connection
+        while not _interrupted.is_set():
+            try:
+                with Connection(args.username, args.password, args.server, args.port) as imap:
+                    while not _interrupted.is_set():
+                        process_mailbox(imap, mailbox, args, archive, pool, keep_selected=True)
+                        imap.idle_until_exists(IDLE_TIMEOUT, _interrupted)
+            except (imaplib.IMAP4.abort, OSError) as e:
+                print(f"{now()} - lost connection for {mailbox}: {e}, reconnecting in {RECONNECT_DELAY}s")
+                _interrupted.wait(RECONNECT_DELAY)
+            except Exception as e: # e.g. SELECT refused, retrying won't help
+                print(f"{now()} - stopped watching {mailbox}: {e!r}")
+                failed.append(mailbox)
+                return
+
+    # opened once for all mailboxes, re-opening per mail re-reads and re-writes the central directory each time
+    level = args.compress_level if args.compress_level is not None else COMPRESS_LEVEL.get(args.compression)
+    with ZipWriter(archive_path, compression=COMPRESSION[args.compression], compresslevel=level,
+            allowZip64=True) if args.zip else nullcontext() as archive, ThreadPoolExecutor(max_workers=4) as pool:
+        if args.daemon:
+            workers = [Thread(target=watcher, args=(mailbox,), daemon=True) for mailbox in mailboxes]
+        else:
+            workers = [Thread(target=worker, daemon=True) for _ in range(min(args.connections, len(mailboxes)))]
+        for w in workers:
+            w.start()
+
+        try:
+            for w in workers:
+                w.join()
+        except KeyboardInterrupt:
+            print(f"{now()} - Interrupted.")
+            _interrupted.set() # let workers finish their current batch
+            for w in workers:
+                w.join()
+            sys.exit(130)
+
+    if failed:
+        print(f"{now()} - done, failed: {','.join(failed)}")
+        return 1
 
     print(f"{now()} - done")
     return None
 
+class ZipWriter:
+    """Owns the zip archive, mails are queued and written by a single thread, since ZipFile isn't thread-safe.
+    The UIDVALIDITY of every mailbox in it and the uids that couldn't be saved are kept in the archive comment."""
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.archive = zf(path, "a", **kwargs)
+        self.names = self.archive.namelist() # snapshot for the dedup check, taken before anything is written
+        try:
+            comment = json.loads(self.archive.comment)
+            self.uidvalidity = comment["uidvalidity"]
+            # null if the list didn't fit into the comment
+            self.retry = {mb: None if uids is None else set(uids) for mb, uids in comment["failed"].items()}
+        except (ValueError, TypeError, KeyError, AttributeError): # no comment, or not one of ours
+            self.uidvalidity, self.retry = {}, {}
+        self.missing = {} # per mailbox, uids to be written in this run and not written yet
+        self.queue = Queue(maxsize=32) # caps the mails held in memory while waiting for the disk
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.queue.put(None)
+        self.thread.join()
+        failed = {mb: None if uids is None else sorted(uids) for mb, uids in {**self.retry, **self.missing}.items()}
+        comment = json.dumps({"uidvalidity": self.uidvalidity, "failed": failed}).encode('utf-8')
+        if len(comment) > 0xFFFF: # zip limit, without the lists the next run compares against all uids instead
+            failed = {mb: None if uids else [] for mb, uids in failed.items()}
+            comment = json.dumps({"uidvalidity": self.uidvalidity, "failed": failed}).encode('utf-8')
+        if comment != self.archive.comment: # unchanged on --dry-run, so the archive isn't rewritten
+            self.archive.comment = comment
+        self.archive.close()
+
+    def expect(self, mailbox, uids) -> None:
+        self.missing[mailbox] = set(uids)
+
+    def write(self, mailbox, uid, file_name, data) -> None:
+        self.queue.put((mailbox, uid, file_name, data))
+
+    def _run(self) -> None:
+        while (item := self.queue.get()) is not None:
+            mailbox, uid, file_name, data = item
+            try:
+                self.archive.writestr(f"{mailbox}/{file_name}", data)
+            except Exception as e: # keep going, a dead writer would block every connection on the full queue
+                print(f"{now()} ---- failed to save {mailbox}/{file_name}: {e}")
+            else:
+                self.missing[mailbox].discard(uid)
+
+class FileWriter:
+    """Writes the mails of a mailbox on a thread pool, so the next fetch doesn't wait for the disk. Each batch is
+    one task, split up when the write slots run out: its files are opened relative to an fd held on the mailbox
+    dir, then all of their uids are appended to the index file with a single write. Expected uids that weren't
+    saved end up in the failed file."""
+    def __init__(self, path, pool, uids, o_direct=False):
+        self.path = path
+        self.pool = pool
+        self.missing = set(uids)
+        self.pending = []
+        self.futures = set()
+        self.lock = Lock()
+        self.o_direct = o_direct and hasattr(os, "O_DIRECT") # linux only
+        # opening relative to a held dir fd skips resolving the full path for every mail
+        self.dir_fd = os.open(path, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0)) if os.open in os.supports_dir_fd else None
+        self.index = open(f"{path}/{INDEX_FILE}", "a")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+        wait(list(self.futures))
+        self.index.close()
+        failed_path = Path(f"{self.path}/{FAILED_FILE}")
+        if self.missing: # not fetched, not saved, or not reached before an interrupt
+            failed_path.write_text("".join(f"{i}\n" for i in sorted(self.missing)))
+        elif failed_path.exists():
+            failed_path.unlink()
+        if self.dir_fd is not None:
+            os.close(self.dir_fd)
+
+    def write(self, uid, file_name, data) -> None:
+        # one slot per mail, so memory doesn't grow with --batch-size
+        if not _write_slots.acquire(blocking=False):
+            self.flush() # slots only come back from mails handed to the pool
+            _write_slots.acquire()
+        self.pending.append((uid, file_name, data))
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+
+        batch, self.pending = self.pending, []
+        future = self.pool.submit(self._save, batch)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future) -> None:
+        with self.lock:
+            self.futures.discard(future)
+        if future.exception():
+            print(f"{now()} ---- failed to save batch: {future.exception()}")
+
+    def _save(self, batch) -> None:
+        try:
+            self._save_files(batch)
+        finally:
+            for _ in batch:
+                _write_slots.release()
+
+    def _save_files(self, batch) -> None:
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+        saved = []
+        for uid, file_name, data in batch:
+            try:
+                if self.o_direct:
+                    try:
+                        self._write_direct(file_name, data, flags)
+                    except OSError as e:
+                        if e.errno != errno.EINVAL:
+                            raise
+                        self.o_direct = False # not supported by the filesystem, e.g. tmpfs
+
+                if not self.o_direct:
+                    self._write(file_name, data, flags)
+            except OSError as e:
+                print(f"{now()} ---- failed to save {file_name}: {e}")
+                continue
+
+            saved.append(uid)
+
+        with self.lock:
+            self.index.write("".join(f"{i}\n" for i in saved))
+            self.index.flush() # a failed index write raises before the uids count as saved
+            self.missing.difference_update(saved)
+
+    def _open(self, file_name, flags) -> int:
+        if self.dir_fd is not None:
+            return os.open(file_name, flags, 0o644, dir_fd=self.dir_fd)
+        return os.open(os.path.join(self.path, file_name), flags, 0o644)
+
+    def _write(self, file_name, data, flags) -> None:
+        fd = self._open(file_name, flags)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+
+    def _write_direct(self, file_name, data, flags) -> None:
+        # O_DIRECT needs aligned memory and length: anonymous mmaps are page-aligned and zero-filled,
+        # the padding is cut off again with ftruncate
+        size = len(data)
+        with mmap.mmap(-1, max(-(-size // _DIRECT_ALIGN) * _DIRECT_ALIGN, _DIRECT_ALIGN)) as buf:
+            buf[:size] = data
+            fd = self._open(file_name, flags | os.O_DIRECT)
+            try:
+                with memoryview(buf) as view:
+                    written = 0
+                    while written < len(buf):
+                        with view[written:] as rest: # views have to be released before the mmap is closed
+                            written += os.write(fd, rest)
+                os.ftruncate(fd, size)
+            finally:
+                os.close(fd)
+
 class Connection(imaplib.IMAP4_SSL):
     def __init__(self, username, password, host, port):
         self.context = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH)
@@ -144,19 +503,99 @@ class Connection(imaplib.IMAP4_SSL):
         super().__init__(host=self.host, port=self.port, ssl_context=self.context)
         self.login(self.username, self.password)
 
+    def send_fetch_pipelined(self, uids, window=_FETCH_WINDOW) -> 'Iterator[tuple(int,bytes,bytes)]':
+        """Send one UID FETCH per run of consecutive uids, up to window of them before waiting for replies,
+        yield (uid, headers, mail) as they arrive. Without a limit, thousands of commands could fill both sides'
+        socket buffers, with client and server each stuck sending."""
+        uid_sets = iter(filter(len, compress_set(uids).split(","))) # ['3:9', '12', ...]
+        pending, done = deque(), []
+        try:
+            try:
+                while True:
+                    for uid_set in islice(uid_sets, window - len(pending)):
+                        tag = self._new_tag()
+                        self.send(b"%s UID FETCH %s %s\r\n" % (tag, uid_set.encode('ascii'), _FETCH_PARTS))
+                        pending.append(tag)
+                    if not pending:
+                        break
+
+                    self._get_response()
+                    yield from parse_fetch_response(self.untagged_responses.pop('FETCH', []))
+                    while pending and self.tagged_commands[pending[0]] is not None: # replies come in order
+                        done.append(pending.popleft())
+            finally: # drain, even if the caller stopped early, so replies don't leak into the next command
+                while any(self.tagged_commands[tag] is None for tag in pending):
+                    self._get_response()
+                self.untagged_responses.pop('FETCH', None)
+
+                for tag in [*done, *pending]:
+                    typ, data = self.tagged_commands.pop(tag)
+                    if typ == 'BAD':
+                        raise self.error(f"fetch: {typ} / {data}")
+        except OSError as e: # like imaplib does for its own commands, so callers see the connection is gone
+            raise self.abort(f"fetch: socket error: {e}")
+
+    def idle_until_exists(self, timeout, stop=None) -> bool:
+        """IDLE on the selected mailbox until the server reports new mail, timeout seconds pass or stop is set"""
+        if 'EXISTS' in self.untagged_responses: # already reported while we were busy
+            self.untagged_responses.pop('EXISTS')
+            return True
+
+        tag = self._new_tag()
+        self.send(b"%s IDLE\r\n" % tag)
+        while self._get_response() is not None: # untagged responses may come before the '+ idling' continuation
+            if self.tagged_commands[tag] is not None:
+                typ, data = self.tagged_commands.pop(tag)
+                raise self.error(f"idle: {typ} / {data}")
+
+        deadline = monotonic() + timeout
+        while 'EXISTS' not in self.untagged_responses and monotonic() < deadline:
+            if stop is not None and stop.is_set():
+                break
+            if self._buffered() or select.select([self.sock], [], [], 1)[0]: # short waits, so stop is noticed
+                self._get_response()
+                if 'BYE' in self.untagged_responses:
+                    raise self.abort(f"idle: {self.untagged_responses['BYE']}")
+
+        self.send(b"DONE\r\n")
+        while self.tagged_commands[tag] is None:
+            self._get_response()
+        self.tagged_commands.pop(tag)
+
+        return self.untagged_responses.pop('EXISTS', None) is not None
+
+    def _buffered(self) -> bool:
+        """Whether a response can be read without blocking. Several may arrive in one TLS record, once the first
+        one is read the rest sit in the buffer of self.file, where neither sock.pending() nor select() sees them"""
+        timeout = self.sock.gettimeout()
+        self.sock.setblocking(False) # peek only reads from the socket if the buffer is empty
+        try:
+            return bool(self.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            self.sock.settimeout(timeout)
+
 def read_config(key):
     try:
         value = config["defaults"][key]
-    except:
+    except KeyError:
         value = None
 
     return value
 
+def read_config_flag(key) -> bool:
+    # read_config() would hand back "false" as a string, which is true
+    try:
+        return config.getboolean("defaults", key, fallback=False)
+    except ValueError:
+        sys.exit(f"config.ini: {key} must be true or false, got '{read_config(key)}'")
+
 if __name__ == "__main__":
     config = configparser.ConfigParser(allow_no_value=True)
     try:
         config.read("config.ini")
-    except:
+    except configparser.Error:
         pass
 
     parser = argparse.ArgumentParser()
@@ -181,12 +620,22 @@ if __name__ == "__main__":
                         help="fetch multiple emails at once, determined by -bs / --batch-size, default: true")
     parser.add_argument("-bs", "--batch-size", dest='batch_size', type=int, default=read_config("batch_size") or 10, 
                         help="how many emails to fetch at once, default: 10")
+    parser.add_argument("-c", "--connections", dest='connections', type=int, default=read_config("connections") or 4,
+                        help="how many mailboxes to fetch concurrently, each on its own connection, default: 4")
     parser.add_argument("--dry-run", dest='dry_run', action='store_true', 
                         help="do not actually write anything, just print, default: false")
     parser.add_argument("-l", "--list-mailboxes", dest='list_mailboxes', action='store_true', 
                         help="list all available mailboxes on server and exit, default: false")
+    parser.add_argument("--daemon", dest='daemon', action='store_true', default=read_config_flag("daemon"),
+                        help="keep running and fetch new emails as the server reports them (IMAP IDLE), default: false")
     parser.add_argument("-z", "--zip", dest='zip', action='store_true', default=read_config("zip") or False,
                         help="zip into archive, default: false")
+    parser.add_argument("--o-direct", dest='o_direct', action='store_true', default=read_config_flag("o_direct"),
+                        help="write files with O_DIRECT, bypassing the page cache (linux, ignored with --zip), default: false")
+    parser.add_argument("--compression", dest='compression', choices=COMPRESSION, default=read_config("compression") or "deflate",
+                        help="compression used for the zip archive, default: deflate")
+    parser.add_argument("--compress-level", dest='compress_level', type=int, default=read_config("compress_level") or None,
+                        help="compression level for deflate (0-9) and zstd, default: 1 for deflate, 3 for zstd")
     args = parser.parse_args()
 
     if len(args.username) == 0: 
@@ -200,4 +649,20 @@ if __name__ == "__main__":
     if not args.batch:
         args.batch_size = 1
 
+    if args.connections < 1:
+        parser.error("--connections must be at least 1")
+
+    if args.daemon and args.zip:
+        parser.error("--daemon can't be combined with --zip, the archive is only complete once it is closed")
+
+    if args.daemon and args.all:
+        parser.error("--daemon can't be combined with --all, every wake-up would fetch the whole mailbox again")
+
+    if args.compression not in COMPRESSION: # argparse doesn't check a default from config.ini against choices
+        parser.error(f"--compression must be one of {', '.join(COMPRESSION)}, got '{args.compression}'"
+                     " (zstd needs python 3.14)")
+
+    if args.compression == "deflate" and args.compress_level not in (None, *range(10)):
+        parser.error("--compress-level must be between 0 and 9 for deflate")
+
     sys.exit(main(args))
\ No newline at end of file